@@ -13,7 +13,6 @@
 import sys
 import ijson
 import operator
-import copy
 import os
 import binascii
 import array
@@ -24,6 +23,13 @@ import random
 import math
 import hashlib
 import re
+import itertools
+import shutil
+import tempfile
+import sqlite3
+import mmap
+import struct
+import heapq
 from collections import OrderedDict
 from scapy import all as scapy
 import bitstring
@@ -38,6 +44,30 @@ try:
 except NameError:
     pass
 
+# Raw field record
+class RawField(object):
+    '''
+    The raw field collected from tshark json
+    :name arg: raw field name (e.g. ip.src_raw)
+    :h arg: hex bytes
+    :p arg: position in bytes
+    :l arg: length in bytes
+    :b arg: bitmask
+    :t arg: type
+    '''
+    __slots__ = ('name', 'h', 'p', 'l', 'b', 't')
+
+    def __init__(self, name, h, p, l, b, t):
+        self.name = name
+        self.h = h
+        self.p = p
+        self.l = l
+        self.b = b
+        self.t = t
+
+    def __repr__(self):
+        return repr([self.h, self.p, self.l, self.b, self.t, self.name])
+
 # Field anonymization class
 class AnonymizedField:
     '''
@@ -87,7 +117,8 @@ class AnonymizedField:
 
         return ret_string
 
-    def anonymize_field(self, _h, _t, salt):
+    # Returns the [start, end) hex offsets of the anonymized part of _h
+    def field_slice(self, _h):
         s = 0
         e = None
         if self.start:
@@ -98,16 +129,157 @@ class AnonymizedField:
                 e = len(_h) + e
         else:
             e = len(_h)
+        return s, e
+
+    def anonymize_field(self, _h, _t, salt, store=None):
+        s, e = self.field_slice(_h)
         h = _h[s:e]
         if self.type == 0:
             h = 'f' * len(h)
         elif self.type == 1:
-            h = self.anonymize_field_shake256(h, _t, salt)
+            if store is not None:
+                h = store.anonymize(self.field, h, _t, salt, self.anonymize_field_shake256)
+            else:
+                h = self.anonymize_field_shake256(h, _t, salt)
 
         h_mask = '0' * len(_h[0:s]) + 'f' * len(h) + '0' * len(_h[e:])
         h = _h[0:s] + h + _h[e:]
         return [h, h_mask]
 
+# Persistent anonymization mapping store
+class AnonymizationStore:
+    '''
+    On-disk sqlite store of original value -> anonymized value pairs shared across runs
+    :path arg: sqlite database filename, created with 0600 permissions if missing
+    :salt arg: salt recorded in the store if the store does not have one yet
+    :batch_size arg: number of new mappings buffered in memory before they are written
+    :cache_size arg: maximum number of mappings kept in memory, least recently used are dropped
+    The salt is recorded in the store on first use and every later run reuses it, so
+    pseudonyms stay consistent and concurrent runs compute identical values.
+    '''
+    def __init__(self, path, salt, batch_size=10000, cache_size=100000):
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS mapping (original TEXT, type INTEGER, anonymized TEXT, field TEXT, PRIMARY KEY (original, type))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS field_mapping (field TEXT, original TEXT, type INTEGER, PRIMARY KEY (field, original, type))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS stats (field TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)")
+        self.db.execute("INSERT OR IGNORE INTO meta VALUES ('salt', ?)", (salt,))
+        self.db.commit()
+        self.salt = self.db.execute("SELECT value FROM meta WHERE key = 'salt'").fetchone()[0]
+        self.batch_size = batch_size
+        self.cache_size = max(cache_size, batch_size)
+        self.cache = OrderedDict()
+        self.pending = []
+        self.fields = set()
+        self.stats = {}
+
+    # Loads the stored mappings of the given (original, type) keys into the cache by one query
+    def prefetch(self, keys):
+        keys = [k for k in set(keys) if k not in self.cache]
+        # sqlite limits the number of bound parameters per statement
+        for i in range(0, len(keys), 400):
+            chunk = keys[i:i + 400]
+            query = "SELECT original, type, anonymized FROM mapping WHERE " + " OR ".join(["(original = ? AND type = ?)"] * len(chunk))
+            params = [v for k in chunk for v in k]
+            for original, t, anonymized in self.db.execute(query, params):
+                self.cache_put((original, t), anonymized)
+
+    def cache_put(self, key, anonymized):
+        self.cache[key] = anonymized
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    # Returns the stored anonymized value, computing and buffering a new mapping if missing
+    def anonymize(self, field, h, t, salt, anonymize_function):
+        stats = self.stats.setdefault(field, [0, 0])
+        key = (h, t)
+        # the same value could be seen in several fields
+        self.fields.add((field, h, t))
+        anonymized = self.cache.get(key)
+        if anonymized is None:
+            anonymized = anonymize_function(h, t, salt)
+            self.cache_put(key, anonymized)
+            self.pending.append((h, t, anonymized, field))
+            stats[1] += 1
+        else:
+            stats[0] += 1
+            self.cache.move_to_end(key)
+        if len(self.pending) >= self.batch_size or len(self.fields) >= self.batch_size:
+            self.flush()
+        return anonymized
+
+    # Counts the lookup of the value which is already in the store
+    def add_hit(self, field):
+        self.stats.setdefault(field, [0, 0])[0] += 1
+
+    # Writes the buffered mappings and the per-field statistics into the store
+    def flush(self):
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO mapping VALUES (?, ?, ?, ?)", self.pending)
+            self.db.executemany("INSERT OR IGNORE INTO field_mapping VALUES (?, ?, ?)", self.fields)
+            self.db.executemany("INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT(field) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses",
+                                [(f, v[0], v[1]) for f, v in self.stats.items()])
+        self.pending = []
+        self.fields = set()
+        self.stats = {}
+
+    # Writes the per-field statistics of the store as csv (field, hits, misses, mappings)
+    def export_stats(self, filename):
+        query = """SELECT s.field, s.hits, s.misses, (SELECT COUNT(*) FROM field_mapping m WHERE m.field = s.field)
+                   FROM stats s ORDER BY s.field"""
+        with open(filename, 'w') as f:
+            f.write("field,hits,misses,mappings\n")
+            for row in self.db.execute(query):
+                f.write(",".join(str(v) for v in row) + "\n")
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+# Reconstructed packet cache
+class PacketCache:
+    '''
+    Bounded LRU cache of the reconstructed frames of structurally identical packets
+    :size arg: maximum number of cached frames
+    :policy arg: string describing the active masking and anonymization policy
+    '''
+    def __init__(self, size, policy):
+        self.size = size
+        self.policy = policy.encode('utf-8')
+        self.frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the digest of frame_raw, raw fields and anonymization policy
+    def key(self, frame_raw, raw_list):
+        digest = hashlib.blake2b(self.policy, digest_size=16)
+        digest.update(frame_raw.encode('ascii'))
+        digest.update(repr(raw_list).encode('utf-8'))
+        return digest.digest()
+
+    def get(self, key):
+        output = self.frames.get(key)
+        if output is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.frames.move_to_end(key)
+        return output
+
+    def put(self, key, output):
+        self.frames[key] = output
+        if len(self.frames) > self.size:
+            self.frames.popitem(last=False)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        ratio = 100.0 * self.hits / lookups if lookups else 0.0
+        return "Packet cache: {} hits of {} packets ({:.1f}%)".format(self.hits, lookups, ratio)
+
 def make_unique(key, dct):
     counter = 0
     unique_key = key
@@ -210,27 +382,62 @@ if __name__ == '__main__':
 # ********** FUNCTIONS ***********
 #
 
-def raw_flat_collector(dict):
-    if hasattr(dict, 'items'):
-        for k, v in dict.items():
+# Returns RawField records of all raw fields in the packet layers
+# The layers are walked by explicit stack of iterators, the input is not modified
+def raw_flat_collector(layers):
+    stack = []
+    if hasattr(layers, 'items'):
+        stack.append(iter(layers.items()))
+
+    while stack:
+        for k, v in stack[-1]:
             if k.endswith("_raw"):
-                # check if the _raw value is nested list
-                if any(isinstance(i, list) for i in v):
-                    for _v in v:
-                        yield k, _v
-                # else
-                else:
-                    yield k, v
-            else:
-                # check if the non _raw value is list
-                if type(v) is list:
-                    for _v in v:
-                        for val in raw_flat_collector(_v):
-                            yield val
-                # else
-                else:
-                    for val in raw_flat_collector(v):
-                        yield val
+                if not isinstance(v, list):
+                    continue
+                # single raw value
+                if v and not isinstance(v[0], list):
+                    if len(v) >= 5:
+                        yield RawField(k, str(v[0]), v[1], v[2], v[3], v[4])
+                    continue
+                # the _raw value is nested list of raw values
+                values = [v]
+                while values:
+                    _v = values.pop()
+                    if not isinstance(_v, list):
+                        continue
+                    if any(isinstance(i, list) for i in _v):
+                        values.extend(reversed(_v))
+                    elif len(_v) >= 5:
+                        yield RawField(k, str(_v[0]), _v[1], _v[2], _v[3], _v[4])
+            # check if the non _raw value is list
+            elif type(v) is list:
+                stack.append(itertools.chain.from_iterable(_v.items() for _v in v if hasattr(_v, 'items')))
+                break
+            elif hasattr(v, 'items'):
+                stack.append(iter(v.items()))
+                break
+        else:
+            stack.pop()
+
+# Returns [frame_raw, frame_time, raw_list, linux_cooked_header] of the packet layers
+# raw_list - RawField records, frame_raw is None if not present
+def collect_packet(layers):
+    frame_raw = None
+    frame_time = None
+    raw_list = []
+    linux_cooked_header = False
+
+    for raw in raw_flat_collector(layers):
+        if (raw.name == "frame_raw"):
+            frame_raw = raw.h
+            if 'frame.time_epoch' in layers['frame']:
+                frame_time = layers['frame']['frame.time_epoch']
+        else:
+            raw_list.append(raw)
+        if (raw.name == "sll_raw"):
+            linux_cooked_header = True
+
+    return [frame_raw, frame_time, raw_list, linux_cooked_header]
 
 # d - input dictionary, parsed from json
 # r - result dictionary
@@ -551,6 +758,549 @@ def generate_pcap(d):
     pcap_out.write(new_packet)
     #print("Generated " + outfile)
 
+# Rewrite frame_raw by the SpilledFields of oversized packet, same as rewrite_frame with
+# frame_mmask for each field, but only the rewritten span is copied instead of whole frame
+def rewrite_spilled_fields(frame_raw, spilled, anonymize, salt, store=None):
+    frame = bytearray(frame_raw.encode('ascii'))
+    frame_mmask = bytearray(b'0' * len(frame)) # initialize anonymization mask
+
+    for raw in spilled.sorted():
+        h = raw.h        # hex
+        p = raw.p * 2    # position
+        h_mask = 'f' * len(h) # hex for modification mask
+
+        # anonymize fields
+        if (raw.name in anonymize):
+            [h, h_mask] = anonymize[raw.name].anonymize_field(h, raw.t, salt, store)
+
+        # currently do not perform modification for bitmask fields, see rewrite_frame
+        if p < 0 or raw.l <= 0 or not h or raw.b != 0:
+            continue
+
+        # keep the bytes which are further not modifiable
+        old = frame[p:p + len(h)]
+        new = bytearray(h.encode('ascii'))
+        for i in range(0, min(len(old), len(new), len(frame_mmask) - p), 2):
+            if frame_mmask[p + i:p + i + 2] == b'ff':
+                new[i:i + 2] = old[i:i + 2]
+        frame[p:p + len(h)] = new
+
+        # update modification mask
+        if (raw.name in anonymize) or (old != new):
+            frame_mmask[p:p + len(h_mask)] = h_mask.encode('ascii')
+
+    return frame.decode('ascii')
+
+# Rewrite frame_raw by all raw fields of the packet and anonymize the selected fields
+# frame_raw - hex bytes of the frame
+# raw_list - RawField records collected from the packet
+# linux_cooked_header - True if the frame has Linux cooked header
+# anonymize - dictionary of AnonymizedField by field name
+# store - optional, AnonymizationStore
+def rewrite_packet(frame_raw, raw_list, linux_cooked_header, anonymize, salt, store=None):
+    # load stored anonymized values of this packet by one query
+    if store is not None:
+        keys = []
+        for raw in raw_list:
+            if raw.name in anonymize and anonymize[raw.name].type == 1:
+                s, e = anonymize[raw.name].field_slice(raw.h)
+                keys.append((raw.h[s:e], raw.t))
+        store.prefetch(keys)
+
+    # oversized packet, the fields are rewritten one by one in place
+    if isinstance(raw_list, SpilledFields):
+        frame_raw = rewrite_spilled_fields(frame_raw, raw_list, anonymize, salt, store)
+        sorted_list = []
+    # sort raw_list
+    else:
+        sorted_list = sorted(raw_list, key=operator.attrgetter('p'), reverse=False)
+        sorted_list = sorted(sorted_list, key=operator.attrgetter('l'), reverse=True)
+        frame_mmask = "0"*len(frame_raw) # initialize anonymization mask
+    # print("Debug: " + str(sorted_list))
+
+    # rewrite frame
+    for raw in sorted_list:
+        h = raw.h        # hex
+        p = raw.p * 2    # position
+        l = raw.l * 2    # length
+        b = raw.b        # bitmask
+        t = raw.t        # type
+        h_mask = 'f' * len(h) # hex for modification mask
+
+        # anonymize fields
+        if (raw.name in anonymize):
+            [h, h_mask] = anonymize[raw.name].anonymize_field(h, t, salt, store)
+
+        #print("Debug: " + str(raw))
+        #print("Debug: " + str(frame_raw))
+        s1 = frame_raw
+        a1 = frame_mmask
+        frame_raw = rewrite_frame(frame_raw, h, p, l, b, t, frame_mmask)
+        s2 = frame_raw
+        a2 = frame_mmask
+
+        #if (s1 != s2):
+        #    print("Modified fields: ")
+        #    print("Field: " + str(raw))
+        #    print("In : " + str(s1))
+        #    print("In amask: " + str(a1))
+        #    print("Out: " + str(s2))
+        #    print("Out amask: " + str(a2))
+        #    d = [i for i in range(len(s1)) if s1[i] != s2[i]]
+        #    print(d)
+        #print("Debug: " + str(frame_raw))
+
+        # update modification mask
+        if (raw.name in anonymize) or (s1 != s2):
+            frame_mmask = rewrite_frame(frame_mmask, h_mask, p, l, b, t)
+
+    # for Linux cooked header replace dest MAC and remove two bytes to reconstruct normal frame
+    if (linux_cooked_header):
+       frame_raw = "000000000000" + frame_raw[6 * 2:]  # replce dest MAC
+       frame_raw = frame_raw[:12 * 2] + "" + frame_raw[14 * 2:]  # remove two bytes before Protocol
+
+    return frame_raw
+
+# Byte order of pcap record headers by the file magic number (microsecond and nanosecond pcap)
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': '<',
+    b'\xa1\xb2\xc3\xd4': '>',
+    b'\x4d\x3c\xb2\xa1': '<',
+    b'\xa1\xb2\x3c\x4d': '>',
+}
+PCAP_COPY_CHUNK = 16 * 1024 * 1024
+
+# Copy bytes [start, end) of the mmap into the file by chunks
+def copy_mmap(mm, f, start, end):
+    for i in range(start, end, PCAP_COPY_CHUNK):
+        f.write(mm[i:min(i + PCAP_COPY_CHUNK, end)])
+
+# Apply raw field edits onto the original pcap, the other frames are copied verbatim
+# infile - original pcap filename
+# outfile - output pcap filename
+# patches - dictionary of [frame_raw, raw_list] by frame number, frame_raw is None if not edited
+# Returns the number of frames in the original pcap
+def patch_pcap(infile, outfile, patches, anonymize, salt, store=None):
+    with open(infile, 'rb') as f_in:
+        mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        endian = PCAP_MAGIC.get(mm[0:4])
+        if endian is None:
+            raise ValueError(infile + " is not a pcap file (pcapng is not supported)")
+        record_header = struct.Struct(endian + 'IIII')
+
+        # outfile is created only for valid pcap
+        with open(outfile, 'wb') as f_out:
+            size = len(mm)
+            offset = 24     # end of the pcap global header
+            copied = 0      # end of the data already written into outfile
+            frame_number = 0
+            while offset + record_header.size <= size:
+                frame_number += 1
+                ts_sec, ts_frac, incl_len, orig_len = record_header.unpack_from(mm, offset)
+                data = offset + record_header.size
+
+                if frame_number in patches:
+                    copy_mmap(mm, f_out, copied, offset)
+                    [frame_raw, raw_list] = patches[frame_number]
+                    # edited frame_raw replaces the original frame as in the json conversion
+                    if frame_raw is None:
+                        frame_raw = binascii.hexlify(mm[data:data + incl_len]).decode('ascii')
+                    frame_raw = rewrite_packet(frame_raw, raw_list, False, anonymize, salt, store)
+                    frame = binascii.unhexlify(frame_raw)
+                    f_out.write(record_header.pack(ts_sec, ts_frac, len(frame), max(0, orig_len + len(frame) - incl_len)))
+                    f_out.write(frame)
+                    copied = data + incl_len
+
+                offset = data + incl_len
+            copy_mmap(mm, f_out, copied, size)
+    finally:
+        mm.close()
+    return frame_number
+
+# Split the pcap into chunks of similar size at the record boundaries
+# Returns the list of chunk filenames created in directory
+def split_pcap(infile, directory, chunks):
+    filenames = []
+    with open(infile, 'rb') as f_in:
+        mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            endian = PCAP_MAGIC.get(mm[0:4])
+            if endian is None:
+                raise ValueError(infile + " is not a pcap file (pcapng is not supported)")
+            record_header = struct.Struct(endian + 'IIII')
+
+            size = len(mm)
+            chunk_size = max(1, (size - 24) // chunks)
+            offset = 24
+            while offset < size:
+                start = offset
+                while offset + record_header.size <= size and offset - start < chunk_size:
+                    incl_len = record_header.unpack_from(mm, offset)[2]
+                    offset += record_header.size + incl_len
+                # truncated last record is kept in the last chunk
+                if offset + record_header.size > size:
+                    offset = size
+
+                filename = os.path.join(directory, 'chunk_{}.pcap'.format(len(filenames)))
+                with open(filename, 'wb') as f_out:
+                    copy_mmap(mm, f_out, 0, 24)
+                    copy_mmap(mm, f_out, start, offset)
+                filenames.append(filename)
+        finally:
+            mm.close()
+    return filenames
+
+# Concatenate the records of pcap files into outfile, the global header is taken from the first not empty file
+# header - global header written if all files are empty
+def merge_pcap(filenames, outfile, header):
+    with open(outfile, 'wb') as f_out:
+        for filename in filenames:
+            if os.path.getsize(filename) < 24:
+                continue
+            with open(filename, 'rb') as f_in:
+                if header is None:
+                    f_in.seek(24)
+                shutil.copyfileobj(f_in, f_out, PCAP_COPY_CHUNK)
+            header = None
+        if header is not None:
+            f_out.write(header)
+
+# Convert the original pcap by concurrent pipelines of tshark and json2pcap, one pipeline per chunk
+# tshark - tshark executable
+# worker_args - json2pcap arguments of the conversion workers (without -i and -o)
+# salt - anonymization salt passed to the workers by JSON2PCAP_SALT environment variable
+def convert_pcap_parallel(infile, outfile, jobs, tshark, worker_args, salt):
+    # the salt is not passed by command line, which is readable by other local users
+    worker_env = dict(os.environ)
+    worker_env['JSON2PCAP_SALT'] = salt
+    directory = tempfile.mkdtemp(prefix='json2pcap_')
+    try:
+        chunks = split_pcap(infile, directory, jobs)
+        outputs = [chunk + '.out.pcap' for chunk in chunks]
+
+        pipelines = []
+        try:
+            for chunk, output in zip(chunks, outputs):
+                exporter = subprocess.Popen([tshark, '-r', chunk, '-T', 'json', '-x', '--no-duplicate-keys'], stdout=subprocess.PIPE)
+                worker = subprocess.Popen([sys.executable, os.path.abspath(__file__), '-o', output] + worker_args, stdin=exporter.stdout, env=worker_env)
+                # the worker owns the pipe, tshark receives SIGPIPE if the worker exits
+                exporter.stdout.close()
+                pipelines.append((chunk, exporter, worker))
+        except OSError:
+            for chunk, exporter, worker in pipelines:
+                exporter.kill()
+                worker.kill()
+            raise
+
+        failed = []
+        for chunk, exporter, worker in pipelines:
+            if worker.wait() != 0 or exporter.wait() != 0:
+                failed.append(os.path.basename(chunk))
+        if failed:
+            raise RuntimeError("conversion of " + ", ".join(failed) + " failed")
+
+        # pcap without records results in the global header of the original pcap
+        with open(infile, 'rb') as f_in:
+            header = f_in.read(24)
+        merge_pcap(outputs, outfile, header)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# Binary file of parsed packets, allows to skip json parsing in repeated runs
+#   header: magic, version
+#   packet: PARSED_PACKET header, frame bytes, PARSED_FIELD table, field hex bytes
+#   name table: count, then length and utf-8 name of each interned field name
+#   trailer: offset of name table, magic
+PARSED_MAGIC = b'J2PP'
+PARSED_VERSION = 1
+PARSED_HEADER = struct.Struct('<4sI')
+PARSED_PACKET = struct.Struct('<IIBd')     # frame length, field count, flags, frame time
+PARSED_FIELD = '<IiiQiI'                   # name id, position, length, bitmask, type, hex length
+PARSED_TRAILER = struct.Struct('<Q4s')
+PARSED_LINUX_COOKED = 0x01
+PARSED_FRAME_TIME = 0x02
+
+# Converts hex string into bytes, odd length is padded by 0
+def hex_to_bytes(h):
+    if len(h) % 2 == 1:
+        h = h + '0'
+    return binascii.unhexlify(h)
+
+# Parsed packets writer
+class ParsedPacketWriter:
+    '''
+    Writes the packets collected from json into binary file read by read_parsed_packets
+    :filename arg: output filename
+    '''
+    def __init__(self, filename):
+        self.f = open(filename, 'wb')
+        self.f.write(PARSED_HEADER.pack(PARSED_MAGIC, PARSED_VERSION))
+        self.names = OrderedDict()
+
+    def write(self, frame_raw, frame_time, raw_list, linux_cooked_header):
+        flags = 0
+        if linux_cooked_header:
+            flags |= PARSED_LINUX_COOKED
+        if frame_time is not None:
+            flags |= PARSED_FRAME_TIME
+        frame = hex_to_bytes(frame_raw or '')
+
+        table = []
+        for raw in raw_list:
+            name_id = self.names.setdefault(raw.name, len(self.names))
+            table.extend((name_id, raw.p, raw.l, raw.b, raw.t, len(raw.h)))
+
+        self.f.write(PARSED_PACKET.pack(len(frame), len(raw_list), flags, float(frame_time or 0)))
+        self.f.write(frame)
+        self.f.write(struct.pack(PARSED_FIELD[0] + PARSED_FIELD[1:] * len(raw_list), *table))
+        self.f.write(b''.join(hex_to_bytes(raw.h) for raw in raw_list))
+
+    def close(self):
+        offset = self.f.tell()
+        self.f.write(struct.pack('<I', len(self.names)))
+        for name in self.names:
+            name = name.encode('utf-8')
+            self.f.write(struct.pack('<H', len(name)) + name)
+        self.f.write(PARSED_TRAILER.pack(offset, PARSED_MAGIC))
+        self.f.close()
+
+# Returns the packets iterator over binary file written by ParsedPacketWriter, the file is memory mapped
+def read_parsed_packets(filename):
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version = PARSED_HEADER.unpack_from(mm, 0)
+        end, trailer_magic = PARSED_TRAILER.unpack_from(mm, len(mm) - PARSED_TRAILER.size)
+    except struct.error:
+        magic = None
+    if magic != PARSED_MAGIC or trailer_magic != PARSED_MAGIC or version != PARSED_VERSION:
+        mm.close()
+        raise ValueError(filename + " is not a complete parsed packets file of version " + str(PARSED_VERSION))
+
+    # interned field name table
+    names = []
+    offset = end + 4
+    for _ in range(struct.unpack_from('<I', mm, end)[0]):
+        length = struct.unpack_from('<H', mm, offset)[0]
+        names.append(sys.intern(mm[offset + 2:offset + 2 + length].decode('utf-8')))
+        offset += 2 + length
+
+    return iter_parsed_packets(mm, names, end)
+
+# Returns [frame_raw, frame_time, raw_list, linux_cooked_header] of each packet stored in mm before end offset
+def iter_parsed_packets(mm, names, end):
+    field_size = struct.calcsize(PARSED_FIELD)
+    offset = PARSED_HEADER.size
+    try:
+        while offset < end:
+            frame_len, count, flags, frame_time = PARSED_PACKET.unpack_from(mm, offset)
+            offset += PARSED_PACKET.size
+            frame_raw = binascii.hexlify(mm[offset:offset + frame_len]).decode('ascii')
+            offset += frame_len
+
+            table = struct.unpack_from(PARSED_FIELD[0] + PARSED_FIELD[1:] * count, mm, offset)
+            offset += field_size * count
+
+            raw_list = []
+            for i in range(0, len(table), 6):
+                name_id, p, l, b, t, h_len = table[i:i + 6]
+                size = (h_len + 1) // 2
+                h = binascii.hexlify(mm[offset:offset + size]).decode('ascii')[:h_len]
+                offset += size
+                raw_list.append(RawField(names[name_id], h, p, l, b, t))
+
+            if not flags & PARSED_FRAME_TIME:
+                frame_time = None
+            yield [frame_raw, frame_time, raw_list, bool(flags & PARSED_LINUX_COOKED)]
+    finally:
+        mm.close()
+
+# Raw fields of oversized packet
+class SpilledFields:
+    '''
+    RawField records of an oversized packet kept in a temporary file
+    The sort keys (-l, p, seq, offset) of the records are written into second temporary
+    file in sorted runs of RUN_SIZE keys, only the last run is kept in memory
+    '''
+    RUN_SIZE = 4096
+
+    def __init__(self):
+        self.f = tempfile.TemporaryFile()
+        self.runs_file = tempfile.TemporaryFile()
+        self.run = []       # keys of the records not yet written into runs_file
+        self.runs = []      # (offset, count) of each sorted run in runs_file
+        self.count = 0
+        self.names = OrderedDict()
+        self.field = struct.Struct(PARSED_FIELD)
+        self.key = struct.Struct('<qqqq')
+
+    def __len__(self):
+        return self.count
+
+    def append(self, raw):
+        name_id = self.names.setdefault(raw.name, len(self.names))
+        self.run.append((-raw.l, raw.p, self.count, self.f.tell()))
+        self.count += 1
+        self.f.write(self.field.pack(name_id, raw.p, raw.l, raw.b, raw.t, len(raw.h)))
+        self.f.write(hex_to_bytes(raw.h))
+        if len(self.run) >= self.RUN_SIZE:
+            self.write_run()
+
+    def write_run(self):
+        self.run.sort()
+        self.runs.append((self.runs_file.tell(), len(self.run)))
+        self.runs_file.write(b''.join(self.key.pack(*k) for k in self.run))
+        self.run = []
+
+    def read(self, mm, offset, names):
+        name_id, p, l, b, t, h_len = self.field.unpack_from(mm, offset)
+        offset += self.field.size
+        h = binascii.hexlify(mm[offset:offset + (h_len + 1) // 2]).decode('ascii')[:h_len]
+        return RawField(names[name_id], h, p, l, b, t), offset + (h_len + 1) // 2
+
+    def read_run(self, mm, offset, count):
+        for i in range(count):
+            yield self.key.unpack_from(mm, offset + i * self.key.size)
+
+    # Returns the records in the collected order
+    def __iter__(self):
+        if not self.count:
+            return
+        self.f.flush()
+        names = list(self.names)
+        mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            for i in range(self.count):
+                raw, offset = self.read(mm, offset, names)
+                yield raw
+        finally:
+            mm.close()
+
+    # Returns the records sorted from the longest, same length records by position,
+    # the sorted runs are merged by heapq
+    def sorted(self):
+        if not self.count:
+            return
+        if self.run:
+            self.write_run()
+        self.f.flush()
+        self.runs_file.flush()
+        names = list(self.names)
+        mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        keys_mm = mmap.mmap(self.runs_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for key in heapq.merge(*[self.read_run(keys_mm, offset, count) for offset, count in self.runs]):
+                yield self.read(mm, key[3], names)[0]
+        finally:
+            keys_mm.close()
+            mm.close()
+
+    def close(self):
+        self.runs_file.close()
+        self.f.close()
+
+# Streaming packet collector
+class StreamingCollector:
+    '''
+    Collects [frame_raw, frame_time, raw_list, linux_cooked_header] of each packet directly
+    from json parser events, without building the dictionary tree of the packet
+    :data_file arg: input json file
+    :budget arg: estimated memory in bytes of the packet, the raw fields of larger packets
+                 are moved into SpilledFields
+    '''
+    # estimated memory of RawField record without the hex string
+    RECORD_SIZE = 200
+    # frame hex and its copies during rewrite: the rewritten frame, the modification mask,
+    # and the output bytes
+    FRAME_COPIES = 5
+    # json parser events of one read buffer are kept in memory, about ten times its size
+    BUF_SIZE = 65536
+
+    def __init__(self, data_file, budget):
+        self.data_file = data_file
+        self.budget = budget
+        self.spilled = 0
+        self.peak = 0
+
+    def __iter__(self):
+        path = []           # key of each open map, None for arrays
+        raw = None          # stack of lists of the _raw value being collected
+        raw_name = None
+        packet = None
+
+        for event, value in ijson.basic_parse(self.data_file, buf_size=self.BUF_SIZE):
+            # collect the _raw value
+            if raw is not None:
+                if event == 'start_array':
+                    raw.append([])
+                elif event == 'end_array':
+                    # add each field as soon as its list is complete, the enclosing
+                    # lists of repeated fields are not kept
+                    self.add(packet, raw_name, raw.pop())
+                    if not raw:
+                        raw = None
+                elif not raw:
+                    # only the lists are raw values
+                    raw = None
+                    if event == 'start_map':
+                        path.append(None)
+                else:
+                    raw[-1].append(value)
+                continue
+
+            if event == 'map_key':
+                path[-1] = value
+                if value.endswith("_raw"):
+                    raw_name = value
+                    raw = []
+                elif value == 'frame.time_epoch' and path[1:] == ['_source', 'layers', 'frame', value]:
+                    packet[1] = True
+            elif event in ('start_map', 'start_array'):
+                # new packet in top level array
+                if event == 'start_map' and len(path) == 1:
+                    packet = [None, None, [], False, 0]
+                path.append(None)
+            elif event in ('end_map', 'end_array'):
+                path.pop()
+                if event == 'end_map' and len(path) == 1:
+                    yield packet[:4]
+                    if isinstance(packet[2], SpilledFields):
+                        packet[2].close()
+                    packet = None
+            elif packet is not None and packet[1] is True:
+                packet[1] = value
+
+    # Add the _raw value into packet [frame_raw, frame_time, raw_list, linux_cooked_header, size]
+    def add(self, packet, k, v):
+        if packet is None:
+            return
+        values = [v]
+        while values:
+            _v = values.pop()
+            if any(isinstance(i, list) for i in _v):
+                values.extend(reversed(_v))
+            elif len(_v) >= 5:
+                raw = RawField(k, str(_v[0]), _v[1], _v[2], _v[3], _v[4])
+                if (k == "frame_raw"):
+                    packet[0] = raw.h
+                    packet[4] += len(raw.h) * self.FRAME_COPIES
+                else:
+                    if (k == "sll_raw"):
+                        packet[3] = True
+                    packet[4] += len(raw.h) + self.RECORD_SIZE
+                    packet[2].append(raw)
+
+                # the frame is always kept in memory, only the raw fields are spilled
+                self.peak = max(self.peak, packet[4])
+                if packet[4] > self.budget and not isinstance(packet[2], SpilledFields):
+                    self.spilled += 1
+                    spilled = SpilledFields()
+                    for r in packet[2]:
+                        spilled.append(r)
+                    packet[2] = spilled
+
 #
 # ************ MAIN **************
 #
@@ -612,13 +1362,31 @@ allowed values of the target field and field encoding.
 """.format(version=VERSION), formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument('--version', action='version', version='%(prog)s ' + VERSION)
 parser.add_argument('-i', '--infile', nargs='?', help='json generated by tshark -T json -x\nor by tshark -T jsonraw (not preserving frame timestamps).\nIf no inpout file is specified script reads from stdin.')
-parser.add_argument('-o', '--outfile', required=True, help='output pcap filename')
+parser.add_argument('-o', '--outfile', help='output pcap filename')
 parser.add_argument('-p', '--python', help='generate python payload instead of pcap (only 1st packet)', default=False, action='store_true')
 parser.add_argument('-m', '--mask', help='mask the specific raw field (e.g. -m "ip.src_raw" -m "ip.dst_raw[2:6]")', action='append', metavar='MASKED_FIELD')
 parser.add_argument('-a', '--anonymize', help='anonymize the specific raw field (e.g. -a "ip.src_raw[2:]" -a "ip.dst_raw[:-2]")', action='append', metavar='ANONYMIZED_FIELD')
-parser.add_argument('-s', '--salt', help='salt use for anonymization. If no value is provided it is randomized.', default=None)
+parser.add_argument('-s', '--salt', help='salt use for anonymization. If no value is provided it is read from JSON2PCAP_SALT\nenvironment variable or randomized.', default=None)
+parser.add_argument('-d', '--mapping-db', help='persistent sqlite store of anonymized values shared across runs.\nThe salt is recorded in the store by the first run and reused by later runs.', default=None, metavar='MAPPING_DB')
+parser.add_argument('--mapping-stats', help='export per-field statistics of the mapping store as csv (requires -d)', default=None, metavar='STATS_CSV')
+parser.add_argument('--patch', help='apply the raw field edits from input json onto the original pcap.\nThe input json contains only the edited packets and fields identified by frame.number,\nthe other frames are copied verbatim.', default=None, metavar='ORIGINAL_PCAP')
+parser.add_argument('--from-pcap', help='run tshark on the original pcap and convert it without intermediate json.\nThe pcap is split into chunks exported and converted concurrently,\nthe output frames keep the original order.', default=None, metavar='ORIGINAL_PCAP')
+parser.add_argument('-j', '--jobs', help='number of concurrent chunks for --from-pcap (default number of CPUs)', default=os.cpu_count() or 1, type=int)
+parser.add_argument('--tshark', help='tshark executable used by --from-pcap (default tshark)', default='tshark')
+parser.add_argument('--save-parsed', help='save the packets parsed from input json into binary file for repeated runs', default=None, metavar='PARSED_FILE')
+parser.add_argument('--load-parsed', help='read the packets from binary file saved by --save-parsed instead of input json', default=None, metavar='PARSED_FILE')
+parser.add_argument('--memory-budget', help='estimated memory budget in MB for one packet, its frame and raw fields. The input\njson is parsed without building the packet trees and the raw fields of larger\npackets are kept in temporary file (default no budget)', default=None, type=float, metavar='MB')
+parser.add_argument('-c', '--packet-cache', help='number of reconstructed packets cached for reuse by identical packets (default 0, the cache is disabled)', default=0, type=int, metavar='PACKETS')
 parser.add_argument('-v', '--verbose', help='verbose output', default=False, action='store_true')
 args = parser.parse_args()
+if args.mapping_stats and not args.mapping_db:
+    parser.error("--mapping-stats requires -d/--mapping-db")
+if args.outfile is None and args.save_parsed is None:
+    parser.error("the following arguments are required: -o/--outfile")
+if (args.save_parsed or args.load_parsed) and (args.patch or args.python):
+    parser.error("--save-parsed and --load-parsed can not be used with --patch or -p")
+if args.from_pcap and (args.patch or args.python or args.save_parsed or args.load_parsed):
+    parser.error("--from-pcap can not be used with --patch, -p, --save-parsed or --load-parsed")
 
 # read JSON
 infile = args.infile
@@ -653,126 +1421,168 @@ frame_raw = ''
 frame_time = None
 
 salt = args.salt
+if salt is None:
+    salt = os.environ.get('JSON2PCAP_SALT')
+salt_specified = salt is not None
 if salt is None:
     # generate random salt if no salt was provided
     salt = ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(10))
 
-# Generate pcap
-if args.python == False:
-    pcap_out = scapy.PcapWriter(outfile, append=False, sync=False)
-
-    # Iterate over packets in JSON
+# Open persistent anonymization mapping store
+store = None
+if args.mapping_db:
+    store = AnonymizationStore(args.mapping_db, salt)
+    if salt_specified and salt != store.salt:
+        print("Error: The salt specified by -s switch or JSON2PCAP_SALT differs from the salt recorded in " + args.mapping_db)
+        sys.exit()
+    salt = store.salt
+
+# Cache of reconstructed packets, the key includes the anonymization policy
+packet_cache = None
+if args.packet_cache > 0:
+    policy = [salt] + sorted((af.field, af.type, af.start, af.end) for af in anonymize.values())
+    packet_cache = PacketCache(args.packet_cache, repr(policy))
+
+# Convert the original pcap by parallel tshark exporters and conversion workers
+if args.from_pcap:
+    # workers share the resolved salt, so the anonymized values are the same in all chunks
+    worker_args = ['-c', str(args.packet_cache)]
+    for af in (args.mask or []):
+        worker_args += ['-m', af]
+    for af in (args.anonymize or []):
+        worker_args += ['-a', af]
+    if args.mapping_db:
+        worker_args += ['-d', args.mapping_db]
+    if args.memory_budget is not None:
+        worker_args += ['--memory-budget', str(args.memory_budget)]
+    if args.verbose:
+        worker_args += ['-v']
+
+    try:
+        convert_pcap_parallel(args.from_pcap, outfile, max(1, args.jobs), args.tshark, worker_args, salt)
+    except (ValueError, RuntimeError, OSError) as e:
+        print("Error: " + str(e))
+        sys.exit(1)
+
+    if store is not None:
+        if args.mapping_stats:
+            store.export_stats(args.mapping_stats)
+        store.close()
+
+# Apply edits onto the original pcap
+elif args.patch:
+    patches = {}
     for packet in ijson.items(data_file, "item", buf_size=200000):
-        _list = []
-        linux_cooked_header = False;
+        layers = packet['_source']['layers']
+        if 'frame' not in layers or 'frame.number' not in layers['frame']:
+            print("Error: The packets in json for --patch switch should include frame.number")
+            sys.exit(1)
+        frame_number = int(layers['frame']['frame.number'])
+        if frame_number in patches:
+            print("Error: The frame.number " + str(frame_number) + " is edited by several packets in json for --patch switch")
+            sys.exit(1)
+        [frame_raw, frame_time, _list, linux_cooked_header] = collect_packet(layers)
+        patches[frame_number] = [frame_raw, _list]
+
+    try:
+        frames = patch_pcap(args.patch, outfile, patches, anonymize, salt, store)
+    except ValueError as e:
+        print("Error: " + str(e))
+        sys.exit(1)
+
+    missing = sorted(n for n in patches if n < 1 or n > frames)
+    if missing:
+        print("Warning: frame.number " + ", ".join(str(n) for n in missing) + " not found in " + args.patch + ", the edits were not applied")
+
+    if store is not None:
+        store.flush()
+        if args.mapping_stats:
+            store.export_stats(args.mapping_stats)
+        store.close()
 
+# Generate pcap
+elif args.python == False:
+    pcap_out = None
+    if outfile:
+        pcap_out = scapy.PcapWriter(outfile, append=False, sync=False)
+
+    parsed_writer = None
+    if args.save_parsed:
+        parsed_writer = ParsedPacketWriter(args.save_parsed)
+
+    # Iterate over packets in JSON or in parsed packets file
+    collector = None
+    if args.load_parsed:
+        try:
+            packets = read_parsed_packets(args.load_parsed)
+        except ValueError as e:
+            print("Error: " + str(e))
+            sys.exit(1)
+    elif args.memory_budget is not None:
+        collector = StreamingCollector(data_file, int(args.memory_budget * 1024 * 1024))
+        packets = iter(collector)
+    else:
         # get flat raw fields into _list
-        for raw in raw_flat_collector(packet['_source']['layers']):
-            if len(raw) >= 2:
-                if (raw[0] == "frame_raw"):
-                    frame_raw = raw[1][0]
-                    frame_mmask = "0"*len(frame_raw) # initialize anonymization mask
-                    input_frame_raw = copy.copy(frame_raw)
-                    frame_time = None
-                    if 'frame.time_epoch' in packet['_source']['layers']['frame']:
-                        frame_time = packet['_source']['layers']['frame']['frame.time_epoch']
-                else:
-                    # add into value list into raw[5] the field name
-                    if isinstance(raw[1], list):
-                        raw[1].append(raw[0])
-                        _list.append(raw[1])
-                if (raw[0] == "sll_raw"):
-                    linux_cooked_header = True
-
-        # sort _list
-        sorted_list = sorted(_list, key=operator.itemgetter(1), reverse=False)
-        sorted_list = sorted(sorted_list, key=operator.itemgetter(2), reverse=True)
-        # print("Debug: " + str(sorted_list))
-
-        # rewrite frame
-        for raw in sorted_list:
-            if len(raw) >= 6:
-                h = str(raw[0])  # hex
-                p = raw[1] * 2   # position
-                l = raw[2] * 2   # length
-                b = raw[3]       # bitmask
-                t = raw[4]       # type
-                # raw[5]         # field_name (added by script)
-                h_mask = 'f' * len(h) # hex for modification mask
-
-                # anonymize fields
-                if (raw[5] in anonymize):
-                    [h, h_mask] = anonymize[raw[5]].anonymize_field(h, t, salt)
-
-                if (isinstance(p, (list, tuple)) or isinstance(l, (list, tuple))):
-                    for r in raw:
-                        _h = str(r[0])  # hex
-                        _p = r[1] * 2   # position
-                        _l = r[2] * 2   # length
-                        _b = r[3]       # bitmask
-                        _t = r[4]       # type
-                        # raw[5]        # field_name (added by script)
-                        _h_mask = 'f' * len(_h) # hex for modification mask
-
-                        # anonymize fields
-                        if (raw[5] in anonymize):
-                            [_h, _h_mask]  = anonymize[raw[5]].anonymize_field(_h, _t, salt)
-
-                        # print("Debug: " + str(raw))
-                        s1 = frame_raw
-                        frame_raw = rewrite_frame(frame_raw, _h, _p, _l, _b, _t, frame_mmask)
-                        s2 = frame_raw
-
-                        # update modification mask
-                        if (raw[5] in anonymize) or (s1 != s2):
-                            frame_mmask = rewrite_frame(frame_mmask, _h_mask, _p, _l, _b, _t)
-
-                else:
-                    #print("Debug: " + str(raw))
-                    #print("Debug: " + str(frame_raw))
-                    s1 = frame_raw
-                    a1 = frame_mmask
-                    frame_raw = rewrite_frame(frame_raw, h, p, l, b, t, frame_mmask)
-                    s2 = frame_raw
-                    a2 = frame_mmask
-
-                    #if (s1 != s2):
-                    #    print("Modified fields: ")
-                    #    print("Field: " + str(raw))
-                    #    print("In : " + str(s1))
-                    #    print("In amask: " + str(a1))
-                    #    print("Out: " + str(s2))
-                    #    print("Out amask: " + str(a2))
-                    #    d = [i for i in range(len(s1)) if s1[i] != s2[i]]
-                    #    print(d)
-                    #print("Debug: " + str(frame_raw))
-
-                    # update modification mask
-                    if (raw[5] in anonymize) or (s1 != s2):
-                        frame_mmask = rewrite_frame(frame_mmask, h_mask, p, l, b, t)
-
-        # for Linux cooked header replace dest MAC and remove two bytes to reconstruct normal frame
-        if (linux_cooked_header):
-           frame_raw = "000000000000" + frame_raw[6 * 2:]  # replce dest MAC
-           frame_raw = frame_raw[:12 * 2] + "" + frame_raw[14 * 2:]  # remove two bytes before Protocol
-
-        # Testing: remove comment to compare input and output for not modified json
-        if (args.verbose and input_frame_raw != frame_raw):
-            #print("Modified frames: ")
-            s1 = input_frame_raw
-            s2 = frame_raw
-            #print(s1)
-            #print(s2)
-            if (len(s1) == len(s2)):
-                d = [i for i in range(len(s1)) if s1[i] != s2[i]]
-                #print(d)
-
-        new_packet = scapy.Packet(bytes(bytearray.fromhex(frame_raw)))
+        packets = (collect_packet(packet['_source']['layers']) for packet in ijson.items(data_file, "item", buf_size=200000))
+
+    for [frame_raw, frame_time, _list, linux_cooked_header] in packets:
+        if parsed_writer is not None:
+            parsed_writer.write(frame_raw, frame_time, _list, linux_cooked_header)
+        if pcap_out is None:
+            continue
+
+        input_frame_raw = frame_raw
+
+        output = None
+        # oversized packets are not cached
+        cacheable = packet_cache is not None and not isinstance(_list, SpilledFields)
+        if cacheable:
+            cache_key = packet_cache.key(frame_raw, _list)
+            output = packet_cache.get(cache_key)
+            # the anonymized values of cached packet are already in the store
+            if output is not None and store is not None:
+                for raw in _list:
+                    if raw.name in anonymize and anonymize[raw.name].type == 1:
+                        store.add_hit(raw.name)
+
+        if output is None:
+            frame_raw = rewrite_packet(frame_raw, _list, linux_cooked_header, anonymize, salt, store)
+
+            # Testing: remove comment to compare input and output for not modified json
+            if (args.verbose and input_frame_raw != frame_raw):
+                #print("Modified frames: ")
+                s1 = input_frame_raw
+                s2 = frame_raw
+                #print(s1)
+                #print(s2)
+                if (len(s1) == len(s2)):
+                    d = [i for i in range(len(s1)) if s1[i] != s2[i]]
+                    #print(d)
+
+            output = bytes(bytearray.fromhex(frame_raw))
+            if cacheable:
+                packet_cache.put(cache_key, output)
+
+        new_packet = scapy.Packet(output)
         if frame_time:
             new_packet.time = float(frame_time)
         #print(type(new_packet))
         pcap_out.write(new_packet)
 
+    if parsed_writer is not None:
+        parsed_writer.close()
+
+    if store is not None:
+        store.flush()
+        if args.mapping_stats:
+            store.export_stats(args.mapping_stats)
+        store.close()
+
+    if args.verbose and packet_cache is not None:
+        print(packet_cache.report())
+    if args.verbose and collector is not None:
+        print("Memory budget: {} oversized packets, largest packet {} bytes estimated".format(collector.spilled, collector.peak))
+
 # Generate python payload only for first packet
 else:
     py_outfile = outfile + '.py'
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# Shared fixtures, json2pcap.py is executed as script because it parses the arguments on import
+
+import os
+import sys
+import json
+import stat
+import subprocess
+
+import pytest
+from scapy.layers.l2 import Ether
+from scapy.layers.inet import IP, UDP
+from scapy.packet import Raw
+from scapy.utils import rdpcap, wrpcap
+
+import tshark_standin
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+JSON2PCAP = os.path.join(os.path.dirname(TESTS_DIR), 'json2pcap.py')
+
+
+def json2pcap(*args):
+    return subprocess.run([sys.executable, JSON2PCAP] + list(args), check=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+
+def frames(filename):
+    return [bytes(p) for p in rdpcap(filename)]
+
+
+@pytest.fixture
+def original(tmp_path):
+    packets = []
+    for i in range(12):
+        p = Ether(src='00:11:22:33:44:55', dst='66:77:88:99:aa:bb') / IP(src='10.0.0.%d' % (i % 3 + 1), dst='192.168.1.1') / UDP(sport=1000, dport=2000) / Raw(b'hello%d' % (i % 2))
+        p.time = 1600000000 + i
+        packets.append(p)
+    filename = str(tmp_path / 'original.pcap')
+    wrpcap(filename, packets)
+    return filename
+
+
+@pytest.fixture
+def exported(tmp_path, original):
+    filename = str(tmp_path / 'original.json')
+    with open(filename, 'w') as f:
+        json.dump([{"_source": {"layers": tshark_standin.packet_layers(p, i + 1)}} for i, p in enumerate(rdpcap(original))], f)
+    return filename
+
+
+@pytest.fixture
+def tshark(tmp_path):
+    filename = str(tmp_path / 'tshark')
+    with open(filename, 'w') as f:
+        f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(TESTS_DIR, 'tshark_standin.py')))
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+    return filename
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import subprocess
+
+from scapy.utils import rdpcap
+
+from conftest import JSON2PCAP, json2pcap, frames
+
+
+def test_json_roundtrip(tmp_path, original, exported):
+    outfile = str(tmp_path / 'out.pcap')
+    json2pcap('-i', exported, '-o', outfile)
+    assert frames(outfile) == frames(original)
+    assert [p.time for p in rdpcap(outfile)] == [p.time for p in rdpcap(original)]
+
+
+def test_from_pcap(tmp_path, original, exported, tshark):
+    outfile = str(tmp_path / 'out.pcap')
+    json2pcap('--from-pcap', original, '-j', '3', '--tshark', tshark, '-o', outfile)
+    assert frames(outfile) == frames(original)
+
+    anonymized = str(tmp_path / 'anonymized.pcap')
+    expected = str(tmp_path / 'expected.pcap')
+    json2pcap('--from-pcap', original, '-j', '4', '--tshark', tshark, '-a', 'ip.src_raw', '-s', 'salt', '-o', anonymized)
+    json2pcap('-i', exported, '-a', 'ip.src_raw', '-s', 'salt', '-o', expected)
+    assert frames(anonymized) == frames(expected)
+    assert frames(anonymized) != frames(original)
+
+
+def test_from_pcap_without_records(tmp_path, original, tshark):
+    empty = str(tmp_path / 'empty.pcap')
+    with open(original, 'rb') as f_in, open(empty, 'wb') as f_out:
+        f_out.write(f_in.read(24))
+    outfile = str(tmp_path / 'out.pcap')
+    json2pcap('--from-pcap', empty, '--tshark', tshark, '-o', outfile)
+    with open(empty, 'rb') as f_in, open(outfile, 'rb') as f_out:
+        assert f_out.read() == f_in.read()
+
+
+def test_salt_environment(tmp_path, exported):
+    expected = str(tmp_path / 'expected.pcap')
+    outfile = str(tmp_path / 'out.pcap')
+    json2pcap('-i', exported, '-a', 'ip.src_raw', '-s', 'salt', '-o', expected)
+    env = dict(os.environ)
+    env['JSON2PCAP_SALT'] = 'salt'
+    subprocess.run([sys.executable, JSON2PCAP, '-i', exported, '-a', 'ip.src_raw', '-o', outfile], check=True, env=env)
+    assert frames(outfile) == frames(expected)
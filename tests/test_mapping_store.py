@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import json
+import subprocess
+import sys
+
+from conftest import JSON2PCAP, json2pcap, frames
+
+
+def test_mapping_store(tmp_path, exported):
+    db = str(tmp_path / 'mapping.db')
+    first = str(tmp_path / 'first.pcap')
+    second = str(tmp_path / 'second.pcap')
+    stats = str(tmp_path / 'stats.csv')
+    json2pcap('-i', exported, '-a', 'ip.src_raw', '-s', 'salt', '-d', db, '-o', first)
+    # second run reuses the salt recorded in the store, the packet cache does not change the statistics
+    json2pcap('-i', exported, '-a', 'ip.src_raw', '-d', db, '-c', '16', '--mapping-stats', stats, '-o', second)
+    assert frames(first) == frames(second)
+    with open(stats) as f:
+        assert f.read().splitlines() == ['field,hits,misses,mappings', 'ip.src_raw,21,3,3']
+
+
+def test_mapping_store_fields(tmp_path, exported):
+    with open(exported) as f:
+        packets = json.load(f)[:2]
+    # the addresses of second packet are swapped
+    ip = packets[1]['_source']['layers']['ip']
+    ip['ip.src_raw'][0], ip['ip.dst_raw'][0] = packets[0]['_source']['layers']['ip']['ip.dst_raw'][0], packets[0]['_source']['layers']['ip']['ip.src_raw'][0]
+    swapped = str(tmp_path / 'swapped.json')
+    with open(swapped, 'w') as f:
+        json.dump(packets, f)
+
+    stats = str(tmp_path / 'stats.csv')
+    json2pcap('-i', swapped, '-a', 'ip.src_raw', '-a', 'ip.dst_raw', '-d', str(tmp_path / 'mapping.db'), '--mapping-stats', stats, '-o', str(tmp_path / 'out.pcap'))
+    with open(stats) as f:
+        assert f.read().splitlines() == ['field,hits,misses,mappings', 'ip.dst_raw,1,1,2', 'ip.src_raw,1,1,2']
+
+
+def test_mapping_stats_requires_store(tmp_path, exported):
+    stats = str(tmp_path / 'stats.csv')
+    result = subprocess.run([sys.executable, JSON2PCAP, '-i', exported, '-a', 'ip.src_raw', '--mapping-stats', stats, '-o', str(tmp_path / 'out.pcap')], stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert '--mapping-stats requires -d/--mapping-db' in result.stderr
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import json
+import binascii
+import subprocess
+
+from conftest import JSON2PCAP, json2pcap, frames
+
+# Runs json2pcap.py with tracemalloc started after the imports and compilation of the script,
+# prints the peak of traced memory
+TRACED_RUN = r'''
+import sys, tracemalloc
+import ijson, scapy.all
+code = compile(open(sys.argv[1]).read(), sys.argv[1], 'exec')
+sys.argv = sys.argv[1:]
+tracemalloc.start()
+exec(code, {'__name__': '__main__', '__file__': sys.argv[0]})
+print('Peak: %d' % tracemalloc.get_traced_memory()[1])
+'''
+
+
+def traced_peak(*args):
+    output = subprocess.run([sys.executable, '-c', TRACED_RUN, JSON2PCAP] + list(args), check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    peak = int(re.search(r'Peak: (\d+)', output).group(1))
+    estimated = int(re.search(r'largest packet (\d+) bytes estimated', output).group(1))
+    return peak, estimated
+
+
+# Single packet with the frame of frame_len bytes and fields of field_len bytes,
+# the fields are repeated over the frame in one data.data_raw list
+def write_packet(filename, fields, frame_len, field_len):
+    h = binascii.hexlify(bytes(i % 251 for i in range(frame_len))).decode('ascii')
+    raw_list = []
+    for i in range(fields):
+        p = i % (frame_len - field_len + 1)
+        raw_list.append([h[p * 2:(p + field_len) * 2], p, field_len, 0, 0])
+    layers = {
+        "frame": {"frame.time_epoch": "1600000000.000000000"},
+        "frame_raw": [h, 0, frame_len, 0, 1],
+        "data": {"data.data_raw": raw_list},
+    }
+    with open(filename, 'w') as f:
+        json.dump([{"_source": {"layers": layers}}], f)
+    return filename
+
+
+def test_memory_budget(tmp_path, exported):
+    expected = str(tmp_path / 'expected.pcap')
+    budget = str(tmp_path / 'budget.pcap')
+    json2pcap('-i', exported, '-a', 'ip.src_raw', '-m', 'eth.src_raw[2:6]', '-s', 'salt', '-o', expected)
+    json2pcap('-i', exported, '-a', 'ip.src_raw', '-m', 'eth.src_raw[2:6]', '-s', 'salt', '-o', budget, '--memory-budget', '0')
+    assert frames(budget) == frames(expected)
+
+
+def test_memory_budget_bounded(tmp_path):
+    small = write_packet(str(tmp_path / 'small.json'), 6000, 256, 1)
+    large = write_packet(str(tmp_path / 'large.json'), 24000, 256, 1)
+    small_peak, _ = traced_peak('-i', small, '-o', str(tmp_path / 'small.pcap'), '--memory-budget', '0', '-v')
+    large_peak, _ = traced_peak('-i', large, '-o', str(tmp_path / 'large.pcap'), '--memory-budget', '0', '-v')
+    assert large_peak - small_peak < 512 * 1024
+    assert frames(str(tmp_path / 'large.pcap')) == frames(str(tmp_path / 'small.pcap'))
+
+
+def test_memory_budget_estimate(tmp_path):
+    # raw fields
+    peak = []
+    estimated = []
+    for fields in (1500, 6000):
+        filename = write_packet(str(tmp_path / 'fields.json'), fields, 256, 8)
+        p, e = traced_peak('-i', filename, '-o', str(tmp_path / 'fields.pcap'), '--memory-budget', '1000', '-v')
+        peak.append(p)
+        estimated.append(e)
+    assert peak[1] - peak[0] <= (estimated[1] - estimated[0]) * 1.1
+    assert estimated[1] - estimated[0] <= (peak[1] - peak[0]) * 2
+
+    # frame
+    peak = []
+    estimated = []
+    for frame_len in (32768, 131072):
+        filename = write_packet(str(tmp_path / 'frame.json'), 4, frame_len, 8)
+        p, e = traced_peak('-i', filename, '-o', str(tmp_path / 'frame.pcap'), '--memory-budget', '1000', '-v')
+        peak.append(p)
+        estimated.append(e)
+    assert peak[1] - peak[0] <= (estimated[1] - estimated[0]) * 1.1
+    assert estimated[1] - estimated[0] <= (peak[1] - peak[0]) * 2
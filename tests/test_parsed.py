@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import subprocess
+
+from scapy.utils import rdpcap
+
+from conftest import JSON2PCAP, json2pcap, frames
+
+
+def test_save_and_load_parsed(tmp_path, exported):
+    parsed = str(tmp_path / 'parsed.j2pp')
+    json2pcap('-i', exported, '--save-parsed', parsed)
+
+    for policy in ([], ['-a', 'ip.src_raw', '-m', 'ip.dst_raw[2:]']):
+        expected = str(tmp_path / 'expected.pcap')
+        loaded = str(tmp_path / 'loaded.pcap')
+        json2pcap('-i', exported, '-s', 'salt', '-o', expected, *policy)
+        json2pcap('--load-parsed', parsed, '-s', 'salt', '-o', loaded, *policy)
+        assert frames(loaded) == frames(expected)
+        assert [p.time for p in rdpcap(loaded)] == [p.time for p in rdpcap(expected)]
+
+
+def test_load_parsed_not_parsed_file(tmp_path, exported):
+    result = subprocess.run([sys.executable, JSON2PCAP, '--load-parsed', exported, '-o', str(tmp_path / 'out.pcap')], stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert 'is not a complete parsed packets file' in result.stdout
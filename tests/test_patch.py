@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import subprocess
+
+from scapy.layers.inet import IP
+from scapy.utils import rdpcap
+
+from conftest import JSON2PCAP, json2pcap, frames
+
+
+def write_edits(tmp_path, edits):
+    filename = str(tmp_path / 'edits.json')
+    with open(filename, 'w') as f:
+        json.dump(edits, f)
+    return filename
+
+
+def test_patch(tmp_path, original, exported):
+    with open(exported) as f:
+        packets = json.load(f)
+    edits = [packets[1], packets[4]]
+    edits[0]['_source']['layers'] = {"frame": {"frame.number": "2"}, "ip": {"ip.dst_raw": ["08080808", 30, 4, 0, 30]}}
+    # edited frame_raw and edited field of the same packet are both applied
+    frame_raw = edits[1]['_source']['layers']['frame_raw']
+    frame_raw[0] = frame_raw[0][:-2] + 'ff'
+    edits[1]['_source']['layers'] = {"frame": {"frame.number": "5"}, "frame_raw": frame_raw, "ip": {"ip.dst_raw": ["05050505", 30, 4, 0, 30]}}
+    patch = str(tmp_path / 'edits.json')
+    with open(patch, 'w') as f:
+        json.dump(edits, f)
+
+    outfile = str(tmp_path / 'patched.pcap')
+    json2pcap('-i', patch, '--patch', original, '-o', outfile)
+    result = rdpcap(outfile)
+    expected = rdpcap(original)
+    assert len(result) == len(expected)
+    for i, (p, e) in enumerate(zip(result, expected)):
+        assert p.time == e.time
+        if i not in (1, 4):
+            assert bytes(p) == bytes(e)
+    assert result[1][IP].dst == '8.8.8.8'
+    assert result[4][IP].dst == '5.5.5.5'
+    assert bytes(result[4])[-1:] == b'\xff'
+
+    converted = str(tmp_path / 'converted.pcap')
+    with open(patch, 'w') as f:
+        json.dump([edits[1]], f)
+    json2pcap('-i', patch, '-o', converted)
+    assert frames(converted) == [bytes(result[4])]
+
+
+def test_patch_missing_frame(tmp_path, original):
+    patch = str(tmp_path / 'edits.json')
+    with open(patch, 'w') as f:
+        json.dump([{"_source": {"layers": {"frame": {"frame.number": "99"}, "ip": {"ip.dst_raw": ["08080808", 30, 4, 0, 30]}}}}], f)
+    outfile = str(tmp_path / 'patched.pcap')
+    result = json2pcap('-i', patch, '--patch', original, '-o', outfile)
+    assert 'frame.number 99 not found' in result.stdout
+    assert frames(outfile) == frames(original)
+
+
+def test_patch_not_pcap(tmp_path, exported):
+    patch = write_edits(tmp_path, [{"_source": {"layers": {"frame": {"frame.number": "1"}}}}])
+    outfile = str(tmp_path / 'patched.pcap')
+    result = subprocess.run([sys.executable, JSON2PCAP, '-i', patch, '--patch', exported, '-o', outfile], stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert 'is not a pcap file' in result.stdout
+    assert not os.path.exists(outfile)
+
+
+def test_patch_duplicate_frame(tmp_path, original):
+    edit = {"_source": {"layers": {"frame": {"frame.number": "2"}, "ip": {"ip.dst_raw": ["08080808", 30, 4, 0, 30]}}}}
+    patch = write_edits(tmp_path, [edit, edit])
+    outfile = str(tmp_path / 'patched.pcap')
+    result = subprocess.run([sys.executable, JSON2PCAP, '-i', patch, '--patch', original, '-o', outfile], stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert 'frame.number 2 is edited by several packets' in result.stdout
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stand-in for "tshark -r <pcap> -T json -x" used by the tests.
+# Writes the raw fields of Ethernet/IPv4/UDP frames in tshark json format.
+
+import sys
+import json
+import binascii
+from scapy.utils import rdpcap
+
+
+def raw(h, offset, length, bitmask=0, type=0):
+    return [h[offset * 2:(offset + length) * 2], offset, length, bitmask, type]
+
+
+def packet_layers(packet, number):
+    h = binascii.hexlify(bytes(packet)).decode('ascii')
+    layers = {
+        "frame": {
+            "frame.time_epoch": "%.9f" % packet.time,
+            "frame.number": str(number),
+        },
+        "frame_raw": raw(h, 0, len(h) // 2),
+        "eth": {
+            "eth.dst_raw": raw(h, 0, 6, 0, 29),
+            "eth.src_raw": raw(h, 6, 6, 0, 29),
+            "eth.type_raw": raw(h, 12, 2, 0, 5),
+        },
+        "eth_raw": raw(h, 0, 14),
+        "ip": {
+            "ip.version_raw": raw(h, 14, 1, 240, 4),
+            "ip.src_raw": raw(h, 26, 4, 0, 30),
+            "ip.dst_raw": raw(h, 30, 4, 0, 30),
+        },
+        "ip_raw": raw(h, 14, 20),
+        "udp": {
+            "udp.srcport_raw": raw(h, 34, 2, 0, 5),
+            "udp.dstport_raw": raw(h, 36, 2, 0, 5),
+        },
+        "udp_raw": raw(h, 34, 8),
+    }
+    if len(h) // 2 > 42:
+        layers["data"] = {"data.data_raw": raw(h, 42, len(h) // 2 - 42, 0, 26)}
+        layers["data_raw"] = raw(h, 42, len(h) // 2 - 42)
+    return layers
+
+
+def main(argv):
+    packets = rdpcap(argv[argv.index('-r') + 1])
+    json.dump([{"_index": "packets", "_source": {"layers": packet_layers(p, i + 1)}} for i, p in enumerate(packets)], sys.stdout)
+
+
+if __name__ == '__main__':
+    main(sys.argv)